@@ -2,12 +2,48 @@
 # Copyright 2016 Canonical Ltd.  This software is licensed under the
 # GNU Affero General Public License version 3 (see the file LICENSE).
 
+from concurrent.futures import ThreadPoolExecutor
+import ctypes
+import fcntl
+import mmap
+import os
 import re
+import stat
+import struct
 import subprocess
 
 # Path to dev. Used for testing this script.
 DEV_PATH = b"/dev/%s"
 
+# Number of 1 MiB buffers handed to the kernel in a single write.
+WRITE_BATCH = 32
+
+# Shared 1 MiB of null bytes used for every zeroing write.
+ZERO_BUF = bytes(1024 * 1024)
+
+# BLKZEROOUT ioctl request number, _IO(0x12, 127) in <linux/fs.h>.
+BLKZEROOUT = 0x127F
+
+# SG_IO ioctl request number and `struct sg_io_hdr` layout from <scsi/sg.h>.
+SG_IO = 0x2285
+SG_IO_HDR = "iiBBHIPPPIIiPBBBBHHiII0P"
+SG_DXFER_FROM_DEV = -3
+
+# ATA PASS-THROUGH (16) command block for IDENTIFY DEVICE (0xEC), read as
+# PIO data-in into a single 512 byte sector. The 12 byte form is avoided as
+# its opcode is also the MMC BLANK command.
+ATA_IDENTIFY_CDB = bytes(
+    [0x85, 0x08, 0x0E, 0, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 0xEC, 0]
+)
+
+# Bits of the security status word (128) of the IDENTIFY DEVICE data.
+ATA_SECURITY_BITS = {
+    b"supported": 0x1,
+    b"enabled": 0x2,
+    b"locked": 0x4,
+    b"frozen": 0x8,
+}
+
 
 class WipeError(Exception):
     """Raised when wiping has failed."""
@@ -29,12 +65,68 @@ def list_disks():
     return disks
 
 
+def ata_identify(disk):
+    """Return the ATA IDENTIFY DEVICE data of the disk.
+
+    The command is sent with the `SG_IO` ioctl, without starting any
+    process. Returns None if the disk cannot answer it, e.g. when it is not
+    an ATA disk.
+    """
+    data = ctypes.create_string_buffer(512)
+    cdb = ctypes.create_string_buffer(ATA_IDENTIFY_CDB, len(ATA_IDENTIFY_CDB))
+    sense = ctypes.create_string_buffer(32)
+    hdr = bytearray(
+        struct.pack(
+            SG_IO_HDR,
+            ord("S"),
+            SG_DXFER_FROM_DEV,
+            len(cdb),
+            len(sense),
+            0,
+            len(data),
+            ctypes.addressof(data),
+            ctypes.addressof(cdb),
+            ctypes.addressof(sense),
+            10000,  # Timeout in milliseconds.
+            *[0] * 12
+        )
+    )
+    try:
+        fd = os.open(DEV_PATH % disk, os.O_RDONLY | os.O_NONBLOCK)
+    except OSError:
+        return None
+    try:
+        fcntl.ioctl(fd, SG_IO, hdr)
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+    fields = struct.unpack(SG_IO_HDR, hdr)
+    status, host_status, driver_status = fields[13], fields[17], fields[18]
+    if status != 0 or host_status != 0 or driver_status != 0:
+        return None
+    return data.raw
+
+
 def get_disk_security_info(disk):
     """Get the disk security information.
 
-    Uses `hdparam` to get security information about the disk. Sadly hdparam
-    doesn't provide an output that makes it easy to parse.
+    The security status word is read from the ATA IDENTIFY DEVICE data when
+    the disk answers it. Otherwise `hdparam` is used to get security
+    information about the disk. Sadly hdparam doesn't provide an output that
+    makes it easy to parse.
     """
+    identity = ata_identify(disk)
+    if identity is not None:
+        (general,) = struct.unpack_from("<H", identity, 0)
+        # Bit 15 of the first word is clear for ATA devices.
+        if not general & 0x8000:
+            (security,) = struct.unpack_from("<H", identity, 128 * 2)
+            return {
+                feature: bool(security & bit)
+                for feature, bit in ATA_SECURITY_BITS.items()
+            }
+
     # Grab the security section for hdparam.
     security_section = []
     output = subprocess.check_output([b"hdparm", b"-I", DEV_PATH % disk])
@@ -69,23 +161,24 @@ def get_disk_info():
 
 def try_secure_erase(kname, info):
     """Try to wipe the disk with secure erase."""
+    name = kname.decode("ascii")
     if info[b"supported"]:
         if info[b"frozen"]:
             print_flush(
                 "%s: not using secure erase; "
-                "drive is currently frozen." % kname.decode("ascii")
+                "drive is currently frozen." % name
             )
             return False
         elif info[b"locked"]:
             print_flush(
                 "%s: not using secure erase; "
-                "drive is currently locked." % kname.decode("ascii")
+                "drive is currently locked." % name
             )
             return False
         elif info[b"enabled"]:
             print_flush(
                 "%s: not using secure erase; "
-                "drive security is already enabled." % kname.decode("ascii")
+                "drive security is already enabled." % name
             )
             return False
         else:
@@ -93,27 +186,20 @@ def try_secure_erase(kname, info):
             try:
                 secure_erase(kname)
             except Exception as e:
-                print_flush(
-                    "%s: failed to be securely erased: %s"
-                    % (kname.decode("ascii"), e)
-                )
+                print_flush("%s: failed to be securely erased: %s" % (name, e))
                 return False
             else:
-                print_flush(
-                    "%s: successfully securely erased."
-                    % (kname.decode("ascii"))
-                )
+                print_flush("%s: successfully securely erased." % name)
                 return True
     else:
-        print_flush(
-            "%s: drive does not support secure erase."
-            % (kname.decode("ascii"))
-        )
+        print_flush("%s: drive does not support secure erase." % name)
         return False
 
 
 def secure_erase(kname):
     """Securely wipe the device."""
+    name = kname.decode("ascii")
+
     # First write 1 MiB of known data to the beginning of the block device.
     # This is used to check at the end of the secure erase that it worked
     # as expected.
@@ -124,8 +210,8 @@ def secure_erase(kname):
     # Before secure erase can be performed on a device a user password must
     # be set. The password will automatically be removed once the drive has
     # been securely erased.
-    print_flush("%s: performing secure erase process." % kname.decode("ascii"))
-    print_flush("%s: setting user password to 'maas'." % kname.decode("ascii"))
+    print_flush("%s: performing secure erase process." % name)
+    print_flush("%s: setting user password to 'maas'." % name)
     try:
         subprocess.check_output(
             [
@@ -150,7 +236,7 @@ def secure_erase(kname):
 
     # Perform the actual secure erase. This will clear the set user password.
     failed_exc = None
-    print_flush("%s: calling secure erase on device." % kname.decode("ascii"))
+    print_flush("%s: calling secure erase on device." % name)
     try:
         subprocess.check_call(
             [
@@ -190,40 +276,132 @@ def wipe_quickly(kname):
     This is not a secure erase but does make it harder to get the data from
     the device.
     """
-    print_flush("%s: starting quick wipe." % kname.decode("ascii"))
-    buf = b"\0" * 1024 * 1024 * 2  # 2 MiB
-    with open(DEV_PATH % kname, "wb") as fp:
-        fp.write(buf)
-        fp.seek(-len(buf), 2)
-        fp.write(buf)
-    print_flush("%s: successfully quickly wiped." % kname.decode("ascii"))
+    name = kname.decode("ascii")
+    print_flush("%s: starting quick wipe." % name)
+    length = 1024 * 1024 * 2  # 2 MiB
+    fd = os.open(DEV_PATH % kname, os.O_WRONLY)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+        zero_range(fd, 0, length)
+        zero_range(fd, max(size - length, 0), length)
+    finally:
+        os.close(fd)
+    print_flush("%s: successfully quickly wiped." % name)
 
 
-def zero_disk(kname):
-    """Zero the entire disk."""
-    # Get the total size of the device.
-    size = 0
-    with open(DEV_PATH % kname, "rb") as fp:
-        fp.seek(0, 2)
-        size = fp.tell()
+def write_zeroes(fd, length, buf=ZERO_BUF):
+    """Write `length` null bytes to `fd` at its current position.
+
+    `buf`, 1 MiB of null bytes, is passed to `os.writev` up to `WRITE_BATCH`
+    times, so large regions are written with few system calls and without
+    allocating any more memory.
+    """
+    while length > 0:
+        count = min(length // len(buf), WRITE_BATCH)
+        if count > 0:
+            written = os.writev(fd, [buf] * count)
+        else:
+            written = os.write(fd, buf[:length])
+        length -= written
 
-    print_flush("%s: started zeroing." % kname.decode("ascii"))
 
-    # Write 1MiB at a time.
-    buf = b"\0" * 1024 * 1024
-    count = size // len(buf)
-    with open(DEV_PATH % kname, "wb") as fp:
-        for _ in range(count):
-            fp.write(buf)
+def send_zeroes(fd, length):
+    """Write `length` null bytes to `fd` at its current position.
+
+    The bytes are copied from /dev/zero with `os.sendfile`, so they never
+    pass through userspace. Whatever the kernel will not send this way is
+    written with `write_zeroes` instead.
+    """
+    zero_fd = os.open("/dev/zero", os.O_RDONLY)
+    try:
+        while length > 0:
+            count = min(length, len(ZERO_BUF) * WRITE_BATCH)
+            try:
+                sent = os.sendfile(fd, zero_fd, None, count)
+            except OSError:
+                break
+            if sent <= 0:
+                break
+            length -= sent
+    finally:
+        os.close(zero_fd)
+    write_zeroes(fd, length)
+
+
+def write_zeroes_direct(fd, length):
+    """Write `length` null bytes to the block device `fd`, bypassing the
+    page cache.
+
+    `O_DIRECT` is set on `fd` while writing, from a page aligned buffer as
+    it requires. If the device does not allow `O_DIRECT` the bytes are sent
+    through the page cache with `send_zeroes` instead.
+    """
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_DIRECT)
+    except OSError:
+        send_zeroes(fd, length)
+        return
+    try:
+        with mmap.mmap(-1, len(ZERO_BUF)) as mm, memoryview(mm) as buf:
+            write_zeroes(fd, length, buf)
+    finally:
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+
+def is_block_device(fd):
+    """Return True if `fd` refers to a block device."""
+    return stat.S_ISBLK(os.fstat(fd).st_mode)
+
+
+def zero_range(fd, offset, length):
+    """Zero `length` bytes of `fd` starting at `offset`.
+
+    Block devices are asked to zero the range themselves with the
+    `BLKZEROOUT` ioctl, so no data is copied from userspace. A device that
+    refuses the request is written to directly with `write_zeroes_direct`,
+    and anything else is sent null bytes with `send_zeroes`.
+    """
+    block_device = is_block_device(fd)
+    if block_device:
+        try:
+            fcntl.ioctl(fd, BLKZEROOUT, struct.pack("QQ", offset, length))
+        except OSError:
+            pass
+        else:
+            return
+    os.lseek(fd, offset, os.SEEK_SET)
+    if block_device:
+        write_zeroes_direct(fd, length)
+    else:
+        send_zeroes(fd, length)
 
-        # If the size of the disk is not divisable by 1 MiB, write the
-        # remaining part of the disk.
-        remaining = size - (count * len(buf))
-        if remaining > 0:
-            buf = b"\0" * remaining
-            fp.write(buf)
 
-    print_flush("%s: successfully zeroed." % kname.decode("ascii"))
+def zero_disk(kname):
+    """Zero the entire disk."""
+    name = kname.decode("ascii")
+    print_flush("%s: started zeroing." % name)
+
+    fd = os.open(DEV_PATH % kname, os.O_WRONLY)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+        zero_range(fd, 0, size)
+    finally:
+        os.close(fd)
+
+    print_flush("%s: successfully zeroed." % name)
+
+
+def wipe_disk(kname, info, use_secure_erase, use_quick_erase):
+    """Wipe the disk using the first method that is requested and works."""
+    wiped = False
+    if use_secure_erase:
+        wiped = try_secure_erase(kname, info)
+    if not wiped:
+        if use_quick_erase:
+            wipe_quickly(kname)
+        else:
+            zero_disk(kname)
 
 
 def main():
@@ -279,16 +457,30 @@ def main():
         "%s to be wiped." % (b", ".join(disk_info.keys())).decode("ascii")
     )
 
-    # Wipe all disks.
-    for kname, info in disk_info.items():
-        wiped = False
-        if args.secure_erase:
-            wiped = try_secure_erase(kname, info)
-        if not wiped:
-            if args.quick_erase:
-                wipe_quickly(kname)
-            else:
-                zero_disk(kname)
+    # Wipe all disks. Each disk is an independent device, so they are all
+    # wiped at the same time.
+    futures = {}
+    if len(disk_info) > 0:
+        with ThreadPoolExecutor(max_workers=len(disk_info)) as executor:
+            for kname, info in disk_info.items():
+                futures[kname] = executor.submit(
+                    wipe_disk, kname, info, args.secure_erase, args.quick_erase
+                )
+
+    # Report every disk that failed, not just the first one.
+    failures = []
+    for kname, future in futures.items():
+        exc = future.exception()
+        if exc is not None:
+            print_flush(
+                "%s: failed to be wiped: %s" % (kname.decode("ascii"), exc)
+            )
+            failures.append((kname, exc))
+    if len(failures) > 0:
+        raise WipeError(
+            "Failed to wipe %s."
+            % (b", ".join(kname for kname, _ in failures)).decode("ascii")
+        ) from failures[0][1]
 
     print_flush("All disks have been successfully wiped.")
 
@@ -6,16 +6,17 @@
 __all__ = []
 
 import argparse
+import ctypes
+import fcntl
+import mmap
+import os
+import shutil
+import struct
 import subprocess
-from textwrap import dedent
-from unittest.mock import call, MagicMock
+import tempfile
+from unittest.mock import call, MagicMock, mock_open, sentinel
 
 from maastesting.factory import factory
-from maastesting.matchers import (
-    MockCalledOnceWith,
-    MockCallsMatch,
-    MockNotCalled,
-)
 from maastesting.testcase import MAASTestCase
 from snippets import maas_wipe
 from snippets.maas_wipe import (
@@ -23,12 +24,23 @@ from snippets.maas_wipe import (
     get_disk_security_info,
     list_disks,
     secure_erase,
+    send_zeroes,
     try_secure_erase,
     wipe_quickly,
     WipeError,
+    write_zeroes,
+    write_zeroes_direct,
     zero_disk,
+    zero_range,
 )
 
+LSBLK_OUTPUT = b"""\
+sda   disk  0
+sdb   disk  1
+sr0   rom   0
+sr1   rom   0
+"""
+
 HDPARM_BEFORE_SECURITY = b"""\
 /dev/sda:
 
@@ -165,313 +177,321 @@ Security:
     4min for SECURITY ERASE UNIT. 2min for ENHANCED SECURITY ERASE UNIT.
 """
 
+# Full hdparm output for each of the security sections above, including
+# one with the security section missing entirely.
+HDPARM_OUTPUTS = {
+    security_section: b"".join(
+        (HDPARM_BEFORE_SECURITY, security_section, HDPARM_AFTER_SECURITY)
+    )
+    for security_section in (
+        b"",
+        HDPARM_SECURITY_NOT_SUPPORTED,
+        HDPARM_SECURITY_SUPPORTED_NOT_ENABLED,
+        HDPARM_SECURITY_SUPPORTED_ENABLED,
+        HDPARM_SECURITY_ALL_TRUE,
+    )
+}
+
+# Security information for a disk in each of the states the tests use.
+SECURITY_INFO_NOT_SUPPORTED = {
+    b"supported": False,
+    b"enabled": False,
+    b"locked": False,
+    b"frozen": False,
+}
+SECURITY_INFO_SUPPORTED = {
+    b"supported": True,
+    b"enabled": False,
+    b"locked": False,
+    b"frozen": False,
+}
+SECURITY_INFO_ENABLED = {
+    b"supported": True,
+    b"enabled": True,
+    b"locked": False,
+    b"frozen": False,
+}
+SECURITY_INFO_LOCKED = {
+    b"supported": True,
+    b"enabled": False,
+    b"locked": True,
+    b"frozen": False,
+}
+SECURITY_INFO_FROZEN = {
+    b"supported": True,
+    b"enabled": False,
+    b"locked": False,
+    b"frozen": True,
+}
+SECURITY_INFO_ALL_TRUE = {
+    b"supported": True,
+    b"enabled": True,
+    b"locked": True,
+    b"frozen": True,
+}
+
+# 1 MiB buffers of each fill byte used by the tests, shared so that they
+# are not rebuilt on every use.
+FILL_BUFFERS = {fill: fill * 1024 * 1024 for fill in (b"\0", b"M", b"T")}
+
+# Reply to ATA IDENTIFY DEVICE used by the SG_IO tests.
+IDENTIFY_DATA = bytes(range(256)) * 2
+
 
 class TestMAASWipe(MAASTestCase):
+    # Disk name for tests that do not depend on it being unique.
+    DISK_NAME = b"disk-fixed"
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Devices are created in a directory shared by the whole class. The
+        # secure erase tests only need the device to exist, and each
+        # overwrites its start before looking at it, so they share one.
+        cls.SHARED_DIR = tempfile.mkdtemp()
+        cls.SHARED_DEV_PATH = (cls.SHARED_DIR + "/%s").encode("ascii")
+        cls.make_empty_file(cls.SHARED_DEV_PATH % cls.DISK_NAME)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.SHARED_DIR)
+        super().tearDownClass()
+
     def setUp(self):
         super().setUp()
-        self.print_flush = self.patch(maas_wipe, "print_flush")
-
-    def make_empty_file(self, path, content=b"\0"):
-        assert len(content) == 1
-        # Make an empty 100 MiB file.
-        buf = content * 1024 * 1024
+        self.patch(maas_wipe, "DEV_PATH", self.SHARED_DEV_PATH)
+        self.mock_check_output = self.patch(subprocess, "check_output")
+        self.mock_check_call = self.patch(subprocess, "check_call")
+
+    @staticmethod
+    def make_empty_file(path, content=b"\0"):
+        assert content in FILL_BUFFERS
+        # Make an empty 5 MiB file.
+        buf = FILL_BUFFERS[content]
         with open(path, "wb") as fp:
-            for _ in range(5):
-                fp.write(buf)
+            if content == b"\0":
+                # Extending a file leaves a hole that reads back as null
+                # bytes, so no data needs to be written.
+                os.ftruncate(fp.fileno(), len(buf) * 5)
+            else:
+                # The data must really be there for the wipe to be checked,
+                # so write it all at once.
+                os.writev(fp.fileno(), [buf] * 5)
 
     def test_list_disks_calls_lsblk(self):
-        mock_check_output = self.patch(subprocess, "check_output")
-        mock_check_output.return_value = b""
+        self.mock_check_output.return_value = b""
         list_disks()
-        self.assertThat(
-            mock_check_output,
-            MockCalledOnceWith(["lsblk", "-d", "-n", "-oKNAME,TYPE,RO"]),
+        self.mock_check_output.assert_called_once_with(
+            ["lsblk", "-d", "-n", "-oKNAME,TYPE,RO"]
         )
 
     def test_list_disks_returns_only_readwrite_disks(self):
-        mock_check_output = self.patch(subprocess, "check_output")
-        mock_check_output.return_value = dedent(
-            """\
-            sda   disk  0
-            sdb   disk  1
-            sr0   rom   0
-            sr1   rom   0
-            """
-        ).encode("ascii")
+        self.mock_check_output.return_value = LSBLK_OUTPUT
         self.assertEqual([b"sda"], list_disks())
 
-    def test_get_disk_security_info_missing(self):
-        hdparm_output = HDPARM_BEFORE_SECURITY + HDPARM_AFTER_SECURITY
-        mock_check_output = self.patch(subprocess, "check_output")
-        mock_check_output.return_value = hdparm_output
+    def check_disk_security_info(
+        self, security_section, expected, identity=None
+    ):
+        self.patch(maas_wipe, "ata_identify").return_value = identity
+        self.mock_check_output.return_value = HDPARM_OUTPUTS[security_section]
         disk_name = factory.make_name("disk").encode("ascii")
         observered = get_disk_security_info(disk_name)
-        self.assertThat(
-            mock_check_output,
-            MockCalledOnceWith([b"hdparm", b"-I", b"/dev/%s" % disk_name]),
-        )
-        self.assertEqual(
-            {
-                b"supported": False,
-                b"enabled": False,
-                b"locked": False,
-                b"frozen": False,
-            },
-            observered,
+        self.mock_check_output.assert_called_once_with(
+            [b"hdparm", b"-I", maas_wipe.DEV_PATH % disk_name]
         )
+        self.assertEqual(expected, observered)
+
+    def test_get_disk_security_info_missing(self):
+        self.check_disk_security_info(b"", SECURITY_INFO_NOT_SUPPORTED)
 
     def test_get_disk_security_info_not_supported(self):
-        hdparm_output = (
-            HDPARM_BEFORE_SECURITY
-            + HDPARM_SECURITY_NOT_SUPPORTED
-            + HDPARM_AFTER_SECURITY
-        )
-        mock_check_output = self.patch(subprocess, "check_output")
-        mock_check_output.return_value = hdparm_output
-        disk_name = factory.make_name("disk").encode("ascii")
-        observered = get_disk_security_info(disk_name)
-        self.assertThat(
-            mock_check_output,
-            MockCalledOnceWith([b"hdparm", b"-I", b"/dev/%s" % disk_name]),
-        )
-        self.assertEqual(
-            {
-                b"supported": False,
-                b"enabled": False,
-                b"locked": False,
-                b"frozen": False,
-            },
-            observered,
+        self.check_disk_security_info(
+            HDPARM_SECURITY_NOT_SUPPORTED, SECURITY_INFO_NOT_SUPPORTED
         )
 
     def test_get_disk_security_info_supported_not_enabled(self):
-        hdparm_output = (
-            HDPARM_BEFORE_SECURITY
-            + HDPARM_SECURITY_SUPPORTED_NOT_ENABLED
-            + HDPARM_AFTER_SECURITY
-        )
-        mock_check_output = self.patch(subprocess, "check_output")
-        mock_check_output.return_value = hdparm_output
-        disk_name = factory.make_name("disk").encode("ascii")
-        observered = get_disk_security_info(disk_name)
-        self.assertThat(
-            mock_check_output,
-            MockCalledOnceWith([b"hdparm", b"-I", b"/dev/%s" % disk_name]),
-        )
-        self.assertEqual(
-            {
-                b"supported": True,
-                b"enabled": False,
-                b"locked": False,
-                b"frozen": False,
-            },
-            observered,
+        self.check_disk_security_info(
+            HDPARM_SECURITY_SUPPORTED_NOT_ENABLED, SECURITY_INFO_SUPPORTED
         )
 
     def test_get_disk_security_info_supported_enabled(self):
-        hdparm_output = (
-            HDPARM_BEFORE_SECURITY
-            + HDPARM_SECURITY_SUPPORTED_ENABLED
-            + HDPARM_AFTER_SECURITY
-        )
-        mock_check_output = self.patch(subprocess, "check_output")
-        mock_check_output.return_value = hdparm_output
-        disk_name = factory.make_name("disk").encode("ascii")
-        observered = get_disk_security_info(disk_name)
-        self.assertThat(
-            mock_check_output,
-            MockCalledOnceWith([b"hdparm", b"-I", b"/dev/%s" % disk_name]),
-        )
-        self.assertEqual(
-            {
-                b"supported": True,
-                b"enabled": True,
-                b"locked": False,
-                b"frozen": False,
-            },
-            observered,
+        self.check_disk_security_info(
+            HDPARM_SECURITY_SUPPORTED_ENABLED, SECURITY_INFO_ENABLED
         )
 
     def test_get_disk_security_info_all_true(self):
-        hdparm_output = (
-            HDPARM_BEFORE_SECURITY
-            + HDPARM_SECURITY_ALL_TRUE
-            + HDPARM_AFTER_SECURITY
+        self.check_disk_security_info(
+            HDPARM_SECURITY_ALL_TRUE, SECURITY_INFO_ALL_TRUE
         )
-        mock_check_output = self.patch(subprocess, "check_output")
-        mock_check_output.return_value = hdparm_output
-        disk_name = factory.make_name("disk").encode("ascii")
-        observered = get_disk_security_info(disk_name)
-        self.assertThat(
-            mock_check_output,
-            MockCalledOnceWith([b"hdparm", b"-I", b"/dev/%s" % disk_name]),
+
+    def test_get_disk_security_info_from_ata_identify(self):
+        identity = bytearray(512)
+        struct.pack_into("<H", identity, 128 * 2, 0x3)
+        self.patch(maas_wipe, "ata_identify").return_value = bytes(identity)
+        observered = get_disk_security_info(self.DISK_NAME)
+        self.mock_check_output.assert_not_called()
+        self.assertEqual(SECURITY_INFO_ENABLED, observered)
+
+    def test_get_disk_security_info_ignores_non_ata_identify(self):
+        identity = bytearray(512)
+        struct.pack_into("<H", identity, 0, 0x8000)
+        struct.pack_into("<H", identity, 128 * 2, 0x3)
+        self.check_disk_security_info(
+            HDPARM_SECURITY_NOT_SUPPORTED,
+            SECURITY_INFO_NOT_SUPPORTED,
+            identity=bytes(identity),
+        )
+
+    def test_ata_identify_returns_none_for_non_device(self):
+        self.assertIsNone(maas_wipe.ata_identify(self.DISK_NAME))
+
+    def patch_sg_io(self, status=0, host_status=0, driver_status=0):
+        """Answer SG_IO requests with `IDENTIFY_DATA` and the given status.
+
+        Returns a list that each request is appended to, as the fd, the
+        ioctl request number, the header fields and the command block.
+        """
+        self.patch(os, "open").return_value = sentinel.fd
+        self.patch(os, "close")
+        requests = []
+
+        def ioctl(fd, request, hdr):
+            fields = list(struct.unpack(maas_wipe.SG_IO_HDR, hdr))
+            cdb = ctypes.string_at(fields[7], fields[2])
+            requests.append((fd, request, fields, cdb))
+            ctypes.memmove(fields[6], IDENTIFY_DATA, fields[5])
+            fields[13], fields[17], fields[18] = (
+                status,
+                host_status,
+                driver_status,
+            )
+            hdr[:] = struct.pack(maas_wipe.SG_IO_HDR, *fields)
+
+        self.patch(fcntl, "ioctl").side_effect = ioctl
+        return requests
+
+    def test_ata_identify_sends_identify_device(self):
+        requests = self.patch_sg_io()
+
+        self.assertEqual(IDENTIFY_DATA, maas_wipe.ata_identify(b"sda"))
+
+        os.open.assert_called_once_with(
+            maas_wipe.DEV_PATH % b"sda", os.O_RDONLY | os.O_NONBLOCK
         )
+        os.close.assert_called_once_with(sentinel.fd)
+        [(fd, request, fields, cdb)] = requests
+        self.assertEqual((sentinel.fd, maas_wipe.SG_IO), (fd, request))
         self.assertEqual(
-            {
-                b"supported": True,
-                b"enabled": True,
-                b"locked": True,
-                b"frozen": True,
-            },
-            observered,
+            [ord("S"), maas_wipe.SG_DXFER_FROM_DEV, 16, 512],
+            [fields[0], fields[1], fields[2], fields[5]],
         )
+        self.assertEqual(maas_wipe.ATA_IDENTIFY_CDB, cdb)
+        self.assertEqual((0x85, 0xEC), (cdb[0], cdb[14]))
+
+    def test_ata_identify_returns_none_on_failed_reply(self):
+        for status in (
+            {"status": 0x02},
+            {"host_status": 0x01},
+            {"driver_status": 0x08},
+        ):
+            self.patch_sg_io(**status)
+            self.assertIsNone(maas_wipe.ata_identify(b"sda"), status)
 
     def test_get_disk_info(self):
         disk_names = [
             factory.make_name("disk").encode("ascii") for _ in range(3)
         ]
         self.patch(maas_wipe, "list_disks").return_value = disk_names
-        security_info = [
-            {
-                b"supported": True,
-                b"enabled": True,
-                b"locked": True,
-                b"frozen": True,
-            }
-            for _ in range(3)
-        ]
+        security_info = [SECURITY_INFO_ALL_TRUE] * 3
         self.patch(
             maas_wipe, "get_disk_security_info"
         ).side_effect = security_info
         observed = get_disk_info()
-        self.assertEqual(
-            {disk_names[i]: security_info[i] for i in range(3)}, observed
-        )
+        self.assertEqual(dict(zip(disk_names, security_info)), observed)
 
     def test_try_secure_erase_not_supported(self):
-        disk_name = factory.make_name("disk").encode("ascii")
-        disk_info = {
-            b"supported": False,
-            b"enabled": False,
-            b"locked": False,
-            b"frozen": False,
-        }
+        print_flush = self.patch(maas_wipe, "print_flush")
+        disk_name = self.DISK_NAME
+        disk_info = SECURITY_INFO_NOT_SUPPORTED
         self.assertFalse(try_secure_erase(disk_name, disk_info))
-        self.assertThat(
-            self.print_flush,
-            MockCalledOnceWith(
-                "%s: drive does not support secure erase."
-                % (disk_name.decode("ascii"))
-            ),
+        print_flush.assert_called_once_with(
+            "%s: drive does not support secure erase."
+            % (disk_name.decode("ascii"))
         )
 
     def test_try_secure_erase_frozen(self):
-        disk_name = factory.make_name("disk").encode("ascii")
-        disk_info = {
-            b"supported": True,
-            b"enabled": False,
-            b"locked": False,
-            b"frozen": True,
-        }
+        print_flush = self.patch(maas_wipe, "print_flush")
+        disk_name = self.DISK_NAME
+        disk_info = SECURITY_INFO_FROZEN
         self.assertFalse(try_secure_erase(disk_name, disk_info))
-        self.assertThat(
-            self.print_flush,
-            MockCalledOnceWith(
-                "%s: not using secure erase; drive is currently frozen."
-                % (disk_name.decode("ascii"))
-            ),
+        print_flush.assert_called_once_with(
+            "%s: not using secure erase; drive is currently frozen."
+            % (disk_name.decode("ascii"))
         )
 
     def test_try_secure_erase_locked(self):
-        disk_name = factory.make_name("disk").encode("ascii")
-        disk_info = {
-            b"supported": True,
-            b"enabled": False,
-            b"locked": True,
-            b"frozen": False,
-        }
+        print_flush = self.patch(maas_wipe, "print_flush")
+        disk_name = self.DISK_NAME
+        disk_info = SECURITY_INFO_LOCKED
         self.assertFalse(try_secure_erase(disk_name, disk_info))
-        self.assertThat(
-            self.print_flush,
-            MockCalledOnceWith(
-                "%s: not using secure erase; drive is currently locked."
-                % (disk_name.decode("ascii"))
-            ),
+        print_flush.assert_called_once_with(
+            "%s: not using secure erase; drive is currently locked."
+            % (disk_name.decode("ascii"))
         )
 
     def test_try_secure_erase_enabled(self):
-        disk_name = factory.make_name("disk").encode("ascii")
-        disk_info = {
-            b"supported": True,
-            b"enabled": True,
-            b"locked": False,
-            b"frozen": False,
-        }
+        print_flush = self.patch(maas_wipe, "print_flush")
+        disk_name = self.DISK_NAME
+        disk_info = SECURITY_INFO_ENABLED
         self.assertFalse(try_secure_erase(disk_name, disk_info))
-        self.assertThat(
-            self.print_flush,
-            MockCalledOnceWith(
-                "%s: not using secure erase; drive security "
-                "is already enabled." % (disk_name.decode("ascii"))
-            ),
+        print_flush.assert_called_once_with(
+            "%s: not using secure erase; drive security "
+            "is already enabled." % (disk_name.decode("ascii"))
         )
 
     def test_try_secure_erase_failed_erase(self):
-        disk_name = factory.make_name("disk").encode("ascii")
-        disk_info = {
-            b"supported": True,
-            b"enabled": False,
-            b"locked": False,
-            b"frozen": False,
-        }
+        print_flush = self.patch(maas_wipe, "print_flush")
+        disk_name = self.DISK_NAME
+        disk_info = SECURITY_INFO_SUPPORTED
         exception = factory.make_exception()
         self.patch(maas_wipe, "secure_erase").side_effect = exception
         self.assertFalse(try_secure_erase(disk_name, disk_info))
-        self.assertThat(
-            self.print_flush,
-            MockCalledOnceWith(
-                "%s: failed to be securely erased: %s"
-                % (disk_name.decode("ascii"), exception)
-            ),
+        print_flush.assert_called_once_with(
+            "%s: failed to be securely erased: %s"
+            % (disk_name.decode("ascii"), exception)
         )
 
     def test_try_secure_erase_successful_erase(self):
-        disk_name = factory.make_name("disk").encode("ascii")
-        disk_info = {
-            b"supported": True,
-            b"enabled": False,
-            b"locked": False,
-            b"frozen": False,
-        }
+        print_flush = self.patch(maas_wipe, "print_flush")
+        disk_name = self.DISK_NAME
+        disk_info = SECURITY_INFO_SUPPORTED
         self.patch(maas_wipe, "secure_erase")
         self.assertTrue(try_secure_erase(disk_name, disk_info))
-        self.assertThat(
-            self.print_flush,
-            MockCalledOnceWith(
-                "%s: successfully securely erased."
-                % (disk_name.decode("ascii"))
-            ),
+        print_flush.assert_called_once_with(
+            "%s: successfully securely erased." % (disk_name.decode("ascii"))
         )
 
     def test_secure_erase_writes_known_data(self):
-        tmp_dir = self.make_dir()
-        dev_path = (tmp_dir + "/%s").encode("ascii")
-        self.patch(maas_wipe, "DEV_PATH", dev_path)
-        dev_name = factory.make_name("disk").encode("ascii")
-        file_path = dev_path % dev_name
-        self.make_empty_file(file_path)
+        self.patch(maas_wipe, "print_flush")
+        dev_name = self.DISK_NAME
+        file_path = maas_wipe.DEV_PATH % dev_name
+        # Nothing is read back before the function stops, so the device
+        # does not need to be touched at all.
+        mock_dev_open = self.patch(maas_wipe, "open", mock_open())
 
         # Fail at the set-pass to stop the function.
-        mock_check_output = self.patch(subprocess, "check_output")
-        mock_check_output.side_effect = factory.make_exception()
+        self.mock_check_output.side_effect = factory.make_exception()
 
         self.assertRaises(WipeError, secure_erase, dev_name)
-        expected_buf = b"M" * 1024 * 1024
-        with open(file_path, "rb") as fp:
-            read_buf = fp.read(len(expected_buf))
-        self.assertEqual(
-            expected_buf, read_buf, "First 1 MiB of file was not written."
+        mock_dev_open.assert_called_once_with(file_path, "wb")
+        mock_dev_open.return_value.write.assert_called_once_with(
+            FILL_BUFFERS[b"M"]
         )
 
     def test_secure_erase_sets_security_password(self):
-        tmp_dir = self.make_dir()
-        dev_path = (tmp_dir + "/%s").encode("ascii")
-        self.patch(maas_wipe, "DEV_PATH", dev_path)
-        dev_name = factory.make_name("disk").encode("ascii")
-        file_path = dev_path % dev_name
-        self.make_empty_file(file_path)
-
-        mock_check_output = self.patch(subprocess, "check_output")
+        self.patch(maas_wipe, "print_flush")
+        dev_name = self.DISK_NAME
+        file_path = maas_wipe.DEV_PATH % dev_name
 
         # Fail to get disk info just to exit early.
         exception_type = factory.make_exception_type()
@@ -480,29 +500,21 @@ class TestMAASWipe(MAASTestCase):
         ).side_effect = exception_type()
 
         self.assertRaises(exception_type, secure_erase, dev_name)
-        self.assertThat(
-            mock_check_output,
-            MockCalledOnceWith(
-                [
-                    b"hdparm",
-                    b"--user-master",
-                    b"u",
-                    b"--security-set-pass",
-                    b"maas",
-                    file_path,
-                ]
-            ),
+        self.mock_check_output.assert_called_once_with(
+            [
+                b"hdparm",
+                b"--user-master",
+                b"u",
+                b"--security-set-pass",
+                b"maas",
+                file_path,
+            ]
         )
 
     def test_secure_erase_fails_if_not_enabled(self):
-        tmp_dir = self.make_dir()
-        dev_path = (tmp_dir + "/%s").encode("ascii")
-        self.patch(maas_wipe, "DEV_PATH", dev_path)
-        dev_name = factory.make_name("disk").encode("ascii")
-        file_path = dev_path % dev_name
-        self.make_empty_file(file_path)
+        self.patch(maas_wipe, "print_flush")
+        dev_name = self.DISK_NAME
 
-        self.patch(subprocess, "check_output")
         self.patch(maas_wipe, "get_disk_security_info").return_value = {
             b"enabled": False
         }
@@ -513,38 +525,29 @@ class TestMAASWipe(MAASTestCase):
         )
 
     def test_secure_erase_fails_when_still_enabled(self):
-        tmp_dir = self.make_dir()
-        dev_path = (tmp_dir + "/%s").encode("ascii")
-        self.patch(maas_wipe, "DEV_PATH", dev_path)
-        dev_name = factory.make_name("disk").encode("ascii")
-        file_path = dev_path % dev_name
-        self.make_empty_file(file_path)
+        self.patch(maas_wipe, "print_flush")
+        dev_name = self.DISK_NAME
+        file_path = maas_wipe.DEV_PATH % dev_name
 
-        mock_check_output = self.patch(subprocess, "check_output")
         self.patch(maas_wipe, "get_disk_security_info").return_value = {
             b"enabled": True
         }
         exception = factory.make_exception()
-        mock_check_call = self.patch(subprocess, "check_call")
-        mock_check_call.side_effect = exception
+        self.mock_check_call.side_effect = exception
 
         error = self.assertRaises(WipeError, secure_erase, dev_name)
-        self.assertThat(
-            mock_check_call,
-            MockCalledOnceWith(
-                [
-                    b"hdparm",
-                    b"--user-master",
-                    b"u",
-                    b"--security-erase",
-                    b"maas",
-                    file_path,
-                ]
-            ),
+        self.mock_check_call.assert_called_once_with(
+            [
+                b"hdparm",
+                b"--user-master",
+                b"u",
+                b"--security-erase",
+                b"maas",
+                file_path,
+            ]
         )
-        self.assertThat(
-            mock_check_output,
-            MockCallsMatch(
+        self.assertEqual(
+            [
                 call(
                     [
                         b"hdparm",
@@ -556,39 +559,32 @@ class TestMAASWipe(MAASTestCase):
                     ]
                 ),
                 call([b"hdparm", b"--security-disable", b"maas", file_path]),
-            ),
+            ],
+            self.mock_check_output.mock_calls,
         )
         self.assertEqual("Failed to securely erase.", str(error))
         self.assertEqual(exception, error.__cause__)
 
     def test_secure_erase_fails_when_buffer_not_different(self):
-        tmp_dir = self.make_dir()
-        dev_path = (tmp_dir + "/%s").encode("ascii")
-        self.patch(maas_wipe, "DEV_PATH", dev_path)
-        dev_name = factory.make_name("disk").encode("ascii")
-        file_path = dev_path % dev_name
-        self.make_empty_file(file_path)
+        self.patch(maas_wipe, "print_flush")
+        dev_name = self.DISK_NAME
+        file_path = maas_wipe.DEV_PATH % dev_name
 
-        self.patch(subprocess, "check_output")
         self.patch(maas_wipe, "get_disk_security_info").side_effect = [
             {b"enabled": True},
             {b"enabled": False},
         ]
-        mock_check_call = self.patch(subprocess, "check_call")
 
         error = self.assertRaises(WipeError, secure_erase, dev_name)
-        self.assertThat(
-            mock_check_call,
-            MockCalledOnceWith(
-                [
-                    b"hdparm",
-                    b"--user-master",
-                    b"u",
-                    b"--security-erase",
-                    b"maas",
-                    file_path,
-                ]
-            ),
+        self.mock_check_call.assert_called_once_with(
+            [
+                b"hdparm",
+                b"--user-master",
+                b"u",
+                b"--security-erase",
+                b"maas",
+                file_path,
+            ]
         )
         self.assertEqual(
             "Secure erase was performed, but failed to actually work.",
@@ -596,14 +592,10 @@ class TestMAASWipe(MAASTestCase):
         )
 
     def test_secure_erase_fails_success(self):
-        tmp_dir = self.make_dir()
-        dev_path = (tmp_dir + "/%s").encode("ascii")
-        self.patch(maas_wipe, "DEV_PATH", dev_path)
-        dev_name = factory.make_name("disk").encode("ascii")
-        file_path = dev_path % dev_name
-        self.make_empty_file(file_path)
+        self.patch(maas_wipe, "print_flush")
+        dev_name = self.DISK_NAME
+        file_path = maas_wipe.DEV_PATH % dev_name
 
-        self.patch(subprocess, "check_output")
         self.patch(maas_wipe, "get_disk_security_info").side_effect = [
             {b"enabled": True},
             {b"enabled": False},
@@ -612,22 +604,18 @@ class TestMAASWipe(MAASTestCase):
         def wipe_buffer(*args, **kwargs):
             # Write the first 1 MiB to zeros so it looks like the device
             # has been securely erased.
-            buf = b"\0" * 1024 * 1024
             with open(file_path, "wb") as fp:
-                fp.write(buf)
+                fp.write(FILL_BUFFERS[b"\0"])
 
-        mock_check_call = self.patch(subprocess, "check_call")
-        mock_check_call.side_effect = wipe_buffer
+        self.mock_check_call.side_effect = wipe_buffer
 
         # No error should be raised.
         secure_erase(dev_name)
 
     def test_wipe_quickly(self):
-        tmp_dir = self.make_dir()
-        dev_path = (tmp_dir + "/%s").encode("ascii")
-        self.patch(maas_wipe, "DEV_PATH", dev_path)
+        self.patch(maas_wipe, "print_flush")
         dev_name = factory.make_name("disk").encode("ascii")
-        file_path = dev_path % dev_name
+        file_path = maas_wipe.DEV_PATH % dev_name
         self.make_empty_file(file_path, content=b"T")
 
         wipe_quickly(dev_name)
@@ -638,16 +626,14 @@ class TestMAASWipe(MAASTestCase):
             fp.seek(-buf_size, 2)
             last_buf = fp.read(buf_size)
 
-        zero_buf = b"\0" * 1024 * 1024
+        zero_buf = FILL_BUFFERS[b"\0"]
         self.assertEqual(zero_buf, first_buf, "First 1 MiB was not wiped.")
         self.assertEqual(zero_buf, last_buf, "Last 1 MiB was not wiped.")
 
     def test_zero_disk(self):
-        tmp_dir = self.make_dir()
-        dev_path = (tmp_dir + "/%s").encode("ascii")
-        self.patch(maas_wipe, "DEV_PATH", dev_path)
+        self.patch(maas_wipe, "print_flush")
         dev_name = factory.make_name("disk").encode("ascii")
-        file_path = dev_path % dev_name
+        file_path = maas_wipe.DEV_PATH % dev_name
         self.make_empty_file(file_path, content=b"T")
 
         # Add a little size to the file making it not evenly
@@ -658,31 +644,107 @@ class TestMAASWipe(MAASTestCase):
 
         zero_disk(dev_name)
 
-        zero_buf = b"\0" * 1024 * 1024
         with open(file_path, "rb") as fp:
-            fp.seek(0, 2)
-            size = fp.tell()
-            fp.seek(0, 0)
-
-            count = size // len(zero_buf)
-            for i in range(count):
-                buf = fp.read(len(zero_buf))
-                self.assertEqual(zero_buf, buf, "%d block was not wiped." % i)
-
-            extra_buf = fp.read(extra_end)
-            self.assertEqual(
-                b"\0" * extra_end, extra_buf, "End was not wiped."
-            )
+            with mmap.mmap(fp.fileno(), 0, prot=mmap.PROT_READ) as mm:
+                size = len(mm) - extra_end
+                # A single comparison lets memcmp scan the whole body.
+                self.assertTrue(
+                    mm[:size] == bytes(size), "Disk was not wiped."
+                )
+                tail = mm[size:]
+        self.assertEqual(
+            FILL_BUFFERS[b"\0"][:extra_end], tail, "End was not wiped."
+        )
+
+    def test_write_zeroes_batches_writes(self):
+        self.patch(maas_wipe, "WRITE_BATCH", 2)
+        mock_writev = self.patch(os, "writev")
+        mock_writev.side_effect = lambda fd, bufs: sum(map(len, bufs))
+        mock_write = self.patch(os, "write")
+        mock_write.side_effect = lambda fd, buf: len(buf)
+
+        write_zeroes(sentinel.fd, 5 * 1024 * 1024 + 512)
+
+        self.assertEqual(
+            [2, 2, 1],
+            [len(bufs) for _, (fd, bufs), _ in mock_writev.mock_calls],
+        )
+        mock_write.assert_called_once_with(
+            sentinel.fd, FILL_BUFFERS[b"\0"][:512]
+        )
+
+    def test_write_zeroes_handles_short_writes(self):
+        # Only the first buffer handed over is ever written.
+        mock_writev = self.patch(os, "writev")
+        mock_writev.side_effect = lambda fd, bufs: len(bufs[0])
+
+        write_zeroes(sentinel.fd, 3 * 1024 * 1024)
+
+        self.assertEqual(
+            [3, 2, 1],
+            [len(bufs) for _, (fd, bufs), _ in mock_writev.mock_calls],
+        )
+
+    def test_send_zeroes_writes_rest_if_sendfile_fails(self):
+        mock_sendfile = self.patch(os, "sendfile")
+        mock_sendfile.side_effect = [4096, OSError()]
+        mock_write_zeroes = self.patch(maas_wipe, "write_zeroes")
+
+        send_zeroes(sentinel.fd, 3 * 4096)
+
+        self.assertEqual(2, mock_sendfile.call_count)
+        mock_write_zeroes.assert_called_once_with(sentinel.fd, 2 * 4096)
+
+    def test_zero_range_uses_blkzeroout_on_block_devices(self):
+        self.patch(maas_wipe, "is_block_device").return_value = True
+        mock_ioctl = self.patch(fcntl, "ioctl")
+        mock_write_zeroes = self.patch(maas_wipe, "write_zeroes")
+
+        zero_range(sentinel.fd, 1024, 4096)
+
+        mock_ioctl.assert_called_once_with(
+            sentinel.fd, maas_wipe.BLKZEROOUT, struct.pack("QQ", 1024, 4096)
+        )
+        mock_write_zeroes.assert_not_called()
+
+    def test_zero_range_writes_zeroes_if_blkzeroout_fails(self):
+        self.patch(maas_wipe, "is_block_device").return_value = True
+        self.patch(fcntl, "ioctl").side_effect = OSError()
+        mock_lseek = self.patch(os, "lseek")
+        mock_write_zeroes_direct = self.patch(maas_wipe, "write_zeroes_direct")
+
+        zero_range(sentinel.fd, 1024, 4096)
+
+        mock_lseek.assert_called_once_with(sentinel.fd, 1024, os.SEEK_SET)
+        mock_write_zeroes_direct.assert_called_once_with(sentinel.fd, 4096)
+
+    def test_write_zeroes_direct_restores_flags(self):
+        dev_name = factory.make_name("disk").encode("ascii")
+        file_path = maas_wipe.DEV_PATH % dev_name
+        self.make_empty_file(file_path, content=b"T")
+        fd = os.open(file_path, os.O_WRONLY)
+        self.addCleanup(os.close, fd)
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        zero_buf = FILL_BUFFERS[b"\0"]
+
+        write_zeroes_direct(fd, len(zero_buf) + 4096)
+
+        self.assertEqual(flags, fcntl.fcntl(fd, fcntl.F_GETFL))
+        with open(file_path, "rb") as fp:
+            self.assertEqual(zero_buf, fp.read(len(zero_buf)))
+            self.assertEqual(zero_buf[:4096], fp.read(4096))
+            self.assertEqual(b"T" * 4096, fp.read(4096))
 
     def patch_args(self, secure_erase, quick_erase):
-        args = MagicMock()
-        args.secure_erase = secure_erase
-        args.quick_erase = quick_erase
+        args = argparse.Namespace(
+            secure_erase=secure_erase, quick_erase=quick_erase
+        )
         parser = MagicMock()
         parser.parse_args.return_value = args
         self.patch(argparse, "ArgumentParser").return_value = parser
 
     def test_main_calls_try_secure_erase_for_all_disks(self):
+        self.patch(maas_wipe, "print_flush")
         self.patch_args(True, False)
         disks = {
             factory.make_name("disk").encode("ascii"): {} for _ in range(3)
@@ -695,10 +757,11 @@ class TestMAASWipe(MAASTestCase):
         maas_wipe.main()
 
         calls = [call(disk, info) for disk, info in disks.items()]
-        self.assertThat(mock_try, MockCallsMatch(*calls))
-        self.assertThat(mock_zero, MockNotCalled())
+        self.assertItemsEqual(calls, mock_try.mock_calls)
+        mock_zero.assert_not_called()
 
     def test_main_calls_zero_disk_if_no_secure_erase(self):
+        self.patch(maas_wipe, "print_flush")
         self.patch_args(True, False)
         disks = {
             factory.make_name("disk").encode("ascii"): {} for _ in range(3)
@@ -712,10 +775,11 @@ class TestMAASWipe(MAASTestCase):
 
         try_calls = [call(disk, info) for disk, info in disks.items()]
         wipe_calls = [call(disk) for disk in disks.keys()]
-        self.assertThat(mock_try, MockCallsMatch(*try_calls))
-        self.assertThat(mock_zero, MockCallsMatch(*wipe_calls))
+        self.assertItemsEqual(try_calls, mock_try.mock_calls)
+        self.assertItemsEqual(wipe_calls, mock_zero.mock_calls)
 
     def test_main_calls_wipe_quickly_if_no_secure_erase(self):
+        self.patch(maas_wipe, "print_flush")
         self.patch_args(True, True)
         disks = {
             factory.make_name("disk").encode("ascii"): {} for _ in range(3)
@@ -729,10 +793,11 @@ class TestMAASWipe(MAASTestCase):
 
         try_calls = [call(disk, info) for disk, info in disks.items()]
         wipe_calls = [call(disk) for disk in disks.keys()]
-        self.assertThat(mock_try, MockCallsMatch(*try_calls))
-        self.assertThat(wipe_quickly, MockCallsMatch(*wipe_calls))
+        self.assertItemsEqual(try_calls, mock_try.mock_calls)
+        self.assertItemsEqual(wipe_calls, wipe_quickly.mock_calls)
 
     def test_main_calls_wipe_quickly(self):
+        self.patch(maas_wipe, "print_flush")
         self.patch_args(False, True)
         disks = {
             factory.make_name("disk").encode("ascii"): {} for _ in range(3)
@@ -745,10 +810,11 @@ class TestMAASWipe(MAASTestCase):
         maas_wipe.main()
 
         wipe_calls = [call(disk) for disk in disks.keys()]
-        self.assertThat(mock_try, MockNotCalled())
-        self.assertThat(wipe_quickly, MockCallsMatch(*wipe_calls))
+        mock_try.assert_not_called()
+        self.assertItemsEqual(wipe_calls, wipe_quickly.mock_calls)
 
     def test_main_calls_zero_disk(self):
+        self.patch(maas_wipe, "print_flush")
         self.patch_args(False, False)
         disks = {
             factory.make_name("disk").encode("ascii"): {} for _ in range(3)
@@ -761,5 +827,44 @@ class TestMAASWipe(MAASTestCase):
         maas_wipe.main()
 
         wipe_calls = [call(disk) for disk in disks.keys()]
-        self.assertThat(mock_try, MockNotCalled())
-        self.assertThat(zero_disk, MockCallsMatch(*wipe_calls))
+        mock_try.assert_not_called()
+        self.assertItemsEqual(wipe_calls, zero_disk.mock_calls)
+
+    def test_main_wipes_other_disks_if_some_fail(self):
+        print_flush = self.patch(maas_wipe, "print_flush")
+        self.patch_args(False, False)
+        disks = {
+            factory.make_name("disk").encode("ascii"): {} for _ in range(3)
+        }
+        self.patch(maas_wipe, "get_disk_info").return_value = disks
+        failing_disks = list(disks)[:2]
+        errors = {
+            kname: WipeError("%s is broken." % kname.decode("ascii"))
+            for kname in failing_disks
+        }
+
+        def fail_disk(kname):
+            if kname in errors:
+                raise errors[kname]
+
+        zero_disk = self.patch(maas_wipe, "zero_disk")
+        zero_disk.side_effect = fail_disk
+        error = self.assertRaises(WipeError, maas_wipe.main)
+        self.assertEqual(
+            "Failed to wipe %s."
+            % ", ".join(kname.decode("ascii") for kname in failing_disks),
+            str(error),
+        )
+        self.assertIs(errors[failing_disks[0]], error.__cause__)
+
+        wipe_calls = [call(disk) for disk in disks.keys()]
+        self.assertItemsEqual(wipe_calls, zero_disk.mock_calls)
+        for kname in failing_disks:
+            name = kname.decode("ascii")
+            print_flush.assert_any_call(
+                "%s: failed to be wiped: %s is broken." % (name, name)
+            )
+        self.assertNotIn(
+            call("All disks have been successfully wiped."),
+            print_flush.mock_calls,
+        )
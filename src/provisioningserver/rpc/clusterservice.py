@@ -5,7 +5,8 @@
 
 __all__ = ["ClusterClientService"]
 
-from functools import partial
+from functools import lru_cache, partial
+from itertools import islice
 import json
 from operator import itemgetter
 import os
@@ -32,7 +33,7 @@ from twisted.internet.error import ConnectError, ConnectionClosed, ProcessDone
 from twisted.internet.threads import deferToThread
 from twisted.protocols import amp
 from twisted.python.reflect import fullyQualifiedName
-from twisted.web.client import _ReadBodyProtocol, Agent
+from twisted.web.client import _ReadBodyProtocol, Agent, HTTPConnectionPool
 from twisted.web.http_headers import Headers
 from zope.interface import implementer
 
@@ -261,6 +262,25 @@ def check_ip_address(request):
     return done
 
 
+# Responses built from the driver registries, keyed by registry. Each is
+# `(items, response)` where `items` is a snapshot of the registry contents.
+_registry_responses = {}
+
+
+def get_registry_response(registry, build):
+    """Return the result of `build()`, cached until `registry` changes.
+
+    The registries are populated at import time and rarely change after
+    that, so responders built purely from them need not rebuild their
+    answer on every call.
+    """
+    items = tuple(registry)
+    cached = _registry_responses.get(registry)
+    if cached is None or cached[0] != items:
+        cached = _registry_responses[registry] = (items, build())
+    return cached[1]
+
+
 class Cluster(RPCProtocol):
     """The RPC protocol supported by a cluster controller.
 
@@ -344,8 +364,12 @@ class Cluster(RPCProtocol):
         # proactively. When a power check is performed it will raise an error
         # if their are any missing packages.
         return {
-            "power_types": list(
-                PowerDriverRegistry.get_schema(detect_missing_packages=False)
+            "power_types": get_registry_response(
+                PowerDriverRegistry,
+                partial(
+                    PowerDriverRegistry.get_schema,
+                    detect_missing_packages=False,
+                ),
             )
         }
 
@@ -361,10 +385,13 @@ class Cluster(RPCProtocol):
     @cluster.ListSupportedArchitectures.responder
     def list_supported_architectures(self):
         return {
-            "architectures": [
-                {"name": arch.name, "description": arch.description}
-                for _, arch in ArchitectureRegistry
-            ]
+            "architectures": get_registry_response(
+                ArchitectureRegistry,
+                lambda: [
+                    {"name": arch.name, "description": arch.description}
+                    for _, arch in ArchitectureRegistry
+                ],
+            )
         }
 
     @cluster.ListOperatingSystems.responder
@@ -1259,6 +1286,18 @@ class ClusterClient(Cluster):
         log.msg("Peer certificate: %r" % self.peerCertificate)
 
 
+@lru_cache(256)
+def get_rpc_info_url(url):
+    """Return the RPC info endpoint for the MAAS `url`, as ASCII bytes.
+
+    This is derived purely from the configured URL, so it is cached rather
+    than rebuilt on every update of `ClusterClientService`.
+    """
+    url = urlparse(url)
+    url = url._replace(path="%s/rpc/" % url.path.rstrip("/"))
+    return ascii_url(url.geturl())
+
+
 class ClusterClientService(TimerService, object):
     """A cluster controller RPC client service.
 
@@ -1284,8 +1323,13 @@ class ClusterClientService(TimerService, object):
         self.connections = {}
         self.try_connections = {}
         self._previous_work = (None, None)
+        self._previous_eventloops = (None, None)
         self.clock = reactor
 
+        # Persistent HTTP connection pool used to fetch the RPC info. This is
+        # created on first use; see `_get_agent`.
+        self._pool = None
+
         # Stored the URL used to connect to the region controller. This will be
         # the URL that was used to get the eventloops.
         self.maas_url = None
@@ -1306,6 +1350,13 @@ class ClusterClientService(TimerService, object):
         self.time_started = self.clock.seconds()
         super().startService()
 
+    def stopService(self):
+        d = maybeDeferred(super().stopService)
+        if self._pool is not None:
+            pool, self._pool = self._pool, None
+            d.addCallback(lambda _: pool.closeCachedConnections())
+        return d
+
     def getClient(self):
         """Returns a :class:`common.Client` connected to a region.
 
@@ -1314,11 +1365,13 @@ class ClusterClientService(TimerService, object):
         :raises: :py:class:`~.exceptions.NoConnectionsAvailable` when
             there are no open connections to a region controller.
         """
-        conns = list(self.connections.values())
-        if len(conns) == 0:
+        if len(self.connections) == 0:
             raise exceptions.NoConnectionsAvailable()
         else:
-            return common.Client(random.choice(conns))
+            # Walk to a random connection rather than copying them all.
+            index = random.randrange(len(self.connections))
+            conn = next(islice(self.connections.values(), index, None))
+            return common.Client(conn)
 
     @deferred
     def getClientNow(self):
@@ -1405,13 +1458,9 @@ class ClusterClientService(TimerService, object):
         """
         Take a list of `urls` and breakdown them down to try IPv6 before IPv4.
         """
-        orig_urls = []
-        for orig_url in urls:
-            url = urlparse(orig_url)
-            url = url._replace(path="%s/rpc/" % url.path.rstrip("/"))
-            url = url.geturl()
-            url = ascii_url(url)
-            orig_urls.append((url, orig_url))
+        orig_urls = [
+            (get_rpc_info_url(orig_url), orig_url) for orig_url in urls
+        ]
 
         urls = []
         for url, orig_url in orig_urls:
@@ -1482,6 +1531,16 @@ class ClusterClientService(TimerService, object):
                     stream.write("http://%s:5240/MAAS\n" % host)
             self._rpc_info_state = connected_addr
 
+    def _get_agent(self):
+        """Return an `Agent` that keeps its connections to the region open.
+
+        The connections are reused by later updates instead of connecting
+        again every time the RPC info is fetched.
+        """
+        if self._pool is None:
+            self._pool = HTTPConnectionPool(reactor, persistent=True)
+        return Agent(reactor, pool=self._pool)
+
     def _fetch_rpc_info(self, url, orig_url):
         def catch_503_error(failure):
             # Catch `twisted.web.error.Error` if has a 503 status code. That
@@ -1498,14 +1557,11 @@ class ClusterClientService(TimerService, object):
             d = Deferred()
             protocol = _ReadBodyProtocol(response.code, response.phrase, d)
             response.deliverBody(protocol)
-            d.addCallback(
-                lambda data: (json.loads(data.decode("utf-8")), orig_url)
-            )
+            d.addCallback(lambda data: (json.loads(data), orig_url))
             return d
 
         # Request the RPC information.
-        agent = Agent(reactor)
-        d = agent.request(
+        d = self._get_agent().request(
             b"GET",
             url,
             Headers(
@@ -1703,15 +1759,16 @@ class ClusterClientService(TimerService, object):
             return str(ipaddr), port
 
         # Ensure that the event-loop addresses are tuples so that
-        # they'll work as dictionary keys.
-        eventloops = {
-            name: [
-                map_to_ipv6(address)
-                for address in addresses
-                if map_to_ipv6(address)
-            ]
-            for name, addresses in eventloops.items()
-        }
+        # they'll work as dictionary keys. The advertised event-loops rarely
+        # change between updates, so this is only redone when they do.
+        previous, normalised = self._previous_eventloops
+        if normalised is None or previous != eventloops:
+            normalised = {
+                name: [map_to_ipv6(address) for address in addresses]
+                for name, addresses in eventloops.items()
+            }
+            self._previous_eventloops = (eventloops, normalised)
+        eventloops = normalised
 
         drop, connect = self._calculate_work(eventloops)
 
@@ -1774,24 +1831,23 @@ class ClusterClientService(TimerService, object):
         # network reconfiguration on the machine hosting the event-loop,
         # and so the connection may have dropped already, but there's
         # nothing wrong with a bit of belt-and-braces engineering
-        # between consenting adults.
-        for eventloop, addresses in eventloops.items():
-            if eventloop in self.connections:
-                connection = self.connections[eventloop]
-                if connection.address not in addresses:
-                    drop[eventloop] = [connection]
-            if eventloop in self.try_connections:
-                connection = self.try_connections[eventloop]
-                if connection.address not in addresses:
-                    drop[eventloop] = [connection]
-
-        # Create new connections to event-loops that the cluster does
-        # not yet have a connection to.
+        # between consenting adults. Create new connections to those
+        # event-loops, and to event-loops that the cluster does not yet
+        # have a connection to.
         for eventloop, addresses in eventloops.items():
+            connection = self.connections.get(eventloop)
+            try_connection = self.try_connections.get(eventloop)
+            if connection is None and try_connection is None:
+                connect[eventloop] = addresses
+                continue
+            if connection is not None and connection.address not in addresses:
+                drop[eventloop] = [connection]
             if (
-                eventloop not in self.connections
-                and eventloop not in self.try_connections
-            ) or eventloop in drop:
+                try_connection is not None
+                and try_connection.address not in addresses
+            ):
+                drop[eventloop] = [try_connection]
+            if eventloop in drop:
                 connect[eventloop] = addresses
 
         # Remove connections to event-loops that are no longer
@@ -1799,13 +1855,11 @@ class ClusterClientService(TimerService, object):
         # the process in which the event-loop is no longer running, but
         # it could be an indicator of a heavily loaded machine, or a
         # fault. In any case, it seems to make sense to disconnect.
-        for eventloop in self.connections:
+        for eventloop, connection in self.connections.items():
             if eventloop not in eventloops:
-                connection = self.connections[eventloop]
                 drop[eventloop] = [connection]
-        for eventloop in self.try_connections:
+        for eventloop, connection in self.try_connections.items():
             if eventloop not in eventloops:
-                connection = self.try_connections[eventloop]
                 drop[eventloop] = [connection]
 
         return drop, connect
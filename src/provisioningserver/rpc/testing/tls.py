@@ -5,26 +5,35 @@
 
 __all__ = ["get_tls_parameters_for_cluster", "get_tls_parameters_for_region"]
 
-from functools import partial
+from functools import lru_cache, partial
 
 from twisted.internet import ssl
 from twisted.python import filepath
 
 
+@lru_cache()
+def _load_certificates(private_cert_name, trust_cert_name):
+    """Load and parse the named certificates once per process."""
+    testing = filepath.FilePath(__file__).parent()
+    with testing.child(private_cert_name).open() as fin:
+        local_certificate = ssl.PrivateCertificate.loadPEM(fin.read())
+    with testing.child(trust_cert_name).open() as fin:
+        trust_certificate = ssl.Certificate.loadPEM(fin.read())
+    return local_certificate, trust_certificate
+
+
 def get_tls_parameters(private_cert_name, trust_cert_name):
     """get_tls_parameters()
 
     Implementation of
     :py:class:`~twisted.protocols.amp.StartTLS`.
     """
-    testing = filepath.FilePath(__file__).parent()
-    with testing.child(private_cert_name).open() as fin:
-        tls_localCertificate = ssl.PrivateCertificate.loadPEM(fin.read())
-    with testing.child(trust_cert_name).open() as fin:
-        tls_verifyAuthorities = [ssl.Certificate.loadPEM(fin.read())]
+    local_certificate, trust_certificate = _load_certificates(
+        private_cert_name, trust_cert_name
+    )
     return {
-        "tls_localCertificate": tls_localCertificate,
-        "tls_verifyAuthorities": tls_verifyAuthorities,
+        "tls_localCertificate": local_certificate,
+        "tls_verifyAuthorities": [trust_certificate],
     }
 
 
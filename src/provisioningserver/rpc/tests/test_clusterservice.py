@@ -41,7 +41,7 @@ from twisted.protocols import amp
 from twisted.python.failure import Failure
 from twisted.python.threadable import isInIOThread
 from twisted.test.proto_helpers import StringTransportWithDisconnection
-from twisted.web.client import Headers
+from twisted.web.client import Headers, HTTPConnectionPool
 from zope.interface.verify import verifyObject
 
 from apiclient.creds import convert_tuple_to_string
@@ -74,6 +74,7 @@ from provisioningserver.dhcp.testing.config import (
     make_shared_network,
     make_shared_network_v1,
 )
+from provisioningserver.drivers import Architecture, ArchitectureRegistry
 from provisioningserver.drivers.nos.registry import NOSDriverRegistry
 from provisioningserver.drivers.osystem import (
     OperatingSystem,
@@ -89,6 +90,9 @@ from provisioningserver.drivers.pod import (
 )
 from provisioningserver.drivers.power import PowerError
 from provisioningserver.drivers.power.registry import PowerDriverRegistry
+from provisioningserver.drivers.power.tests.test_base import (
+    make_power_driver_base,
+)
 from provisioningserver.path import get_maas_data_path
 from provisioningserver.rpc import (
     boot_images,
@@ -109,6 +113,7 @@ from provisioningserver.rpc.clusterservice import (
     ClusterClientCheckerService,
     ClusterClientService,
     executeScanNetworksSubprocess,
+    get_rpc_info_url,
     get_scan_all_networks_args,
     spawnProcessAndNullifyStdout,
 )
@@ -448,6 +453,20 @@ class TestClusterProtocol_DescribePowerTypes(MAASTestCase):
             response["power_types"],
         )
 
+    @inlineCallbacks
+    def test_describe_power_types_returns_newly_registered_drivers(self):
+        yield call_responder(Cluster(), cluster.DescribePowerTypes, {})
+        driver = make_power_driver_base()
+        PowerDriverRegistry.register_item(driver.name, driver)
+        self.addCleanup(PowerDriverRegistry.unregister_item, driver.name)
+        response = yield call_responder(
+            Cluster(), cluster.DescribePowerTypes, {}
+        )
+        self.assertIn(
+            driver.name,
+            [power_type["name"] for power_type in response["power_types"]],
+        )
+
 
 class TestClusterProtocol_DescribeNOSTypes(MAASTestCase):
 
@@ -483,6 +502,18 @@ def make_inert_client_service():
     return service
 
 
+class TestGetRPCInfoURL(MAASTestCase):
+    def test_appends_rpc_path(self):
+        self.assertThat(
+            get_rpc_info_url("http://example.com:5240/MAAS/"),
+            Equals(b"http://example.com:5240/MAAS/rpc/"),
+        )
+
+    def test_returns_same_object_for_same_url(self):
+        url = "http://%s:5240/MAAS" % factory.make_hostname()
+        self.assertIs(get_rpc_info_url(url), get_rpc_info_url(url))
+
+
 class TestClusterClientService(MAASTestCase):
 
     run_tests_with = MAASTwistedRunTest.make_factory(timeout=5)
@@ -949,6 +980,31 @@ class TestClusterClientService(MAASTestCase):
             ),
         )
 
+    @inlineCallbacks
+    def test_update_connections_reuses_unchanged_eventloops(self):
+        service = ClusterClientService(Clock())
+        _calculate_work = self.patch(service, "_calculate_work")
+        _calculate_work.return_value = {}, {}
+
+        for _ in range(2):
+            info = json.loads(
+                self.example_rpc_info_view_response.decode("ascii")
+            )
+            yield service._update_connections(info["eventloops"])
+
+        first, second = (args[0] for args, _ in _calculate_work.call_args_list)
+        self.assertIs(first, second)
+
+    def test_calculate_work_drops_retired_eventloops_in_order(self):
+        service = ClusterClientService(Clock())
+        eventloops = [factory.make_name("eventloop") for _ in range(5)]
+        service.connections = {
+            eventloop: DummyConnection() for eventloop in eventloops
+        }
+        drop, connect = service._calculate_work({})
+        self.assertEqual(eventloops, list(drop))
+        self.assertEqual({}, connect)
+
     @inlineCallbacks
     def test_update_connections_initially(self):
         service = ClusterClientService(Clock())
@@ -1171,6 +1227,40 @@ class TestClusterClientService(MAASTestCase):
             connection.transport.loseConnection, MockCalledOnceWith()
         )
 
+    def test_fetch_rpc_info_reuses_one_connection_pool(self):
+        mock_agent = MagicMock()
+        mock_agent.request.return_value = Deferred()
+        Agent = self.patch(clusterservice, "Agent")
+        Agent.return_value = mock_agent
+        service = ClusterClientService(Clock())
+        for _ in range(2):
+            service._fetch_rpc_info(
+                b"http://127.0.0.1/MAAS/rpc/", "http://127.0.0.1/MAAS"
+            )
+        self.assertThat(service._pool, IsInstance(HTTPConnectionPool))
+        self.assertTrue(service._pool.persistent)
+        self.assertEqual(
+            [call(reactor, pool=service._pool)] * 2, Agent.call_args_list
+        )
+
+    @inlineCallbacks
+    def test_stopService_closes_cached_connections(self):
+        service = make_inert_client_service()
+        service.startService()
+        pool = service._pool = Mock()
+        pool.closeCachedConnections.return_value = succeed(None)
+        yield service.stopService()
+        pool.closeCachedConnections.assert_called_once_with()
+        self.assertIsNone(service._pool)
+
+    @inlineCallbacks
+    def test_stopService_without_connection_pool(self):
+        service = make_inert_client_service()
+        service.startService()
+        yield service.stopService()
+        self.assertIsNone(service._pool)
+        self.assertFalse(service.running)
+
     def test_add_connection_removes_from_try_connections(self):
         service = make_inert_client_service()
         service.startService()
@@ -1258,6 +1348,17 @@ class TestClusterClientService(MAASTestCase):
             {common.Client(conn) for conn in service.connections.values()},
         )
 
+    def test_getClient_picks_connection_by_random_index(self):
+        service = ClusterClientService(Clock())
+        conns = [DummyConnection() for _ in range(3)]
+        service.connections = {
+            sentinel.eventloop01: conns[0],
+            sentinel.eventloop02: conns[1],
+            sentinel.eventloop03: conns[2],
+        }
+        self.patch(random, "randrange").return_value = 2
+        self.assertEqual(common.Client(conns[2]), service.getClient())
+
     def test_getClient_when_there_are_no_connections(self):
         service = ClusterClientService(Clock())
         service.connections = {}
@@ -2095,6 +2196,23 @@ class TestClusterProtocol_ListSupportedArchitectures(MAASTestCase):
             architectures["architectures"],
         )
 
+    @inlineCallbacks
+    def test_returns_newly_registered_architectures(self):
+        yield call_responder(Cluster(), cluster.ListSupportedArchitectures, {})
+        arch = Architecture(
+            name=factory.make_name("arch"),
+            description=factory.make_name("description"),
+        )
+        ArchitectureRegistry.register_item(arch.name, arch)
+        self.addCleanup(ArchitectureRegistry.unregister_item, arch.name)
+        architectures = yield call_responder(
+            Cluster(), cluster.ListSupportedArchitectures, {}
+        )
+        self.assertIn(
+            {"name": arch.name, "description": arch.description},
+            architectures["architectures"],
+        )
+
 
 class TestClusterProtocol_ListOperatingSystems(MAASTestCase):
 